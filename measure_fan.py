@@ -1,16 +1,109 @@
 import os
+import json
+import array
+import math
 import time
+import statistics
 import configfile
-from enum import Enum
+from enum import IntEnum
+
+CSV_ROW_FORMAT = "%.2f, %.2f\n"
+SPINUP_HISTORY_FILE = "/tmp/fan_spinup_hist.json"
+SPINUP_HISTORY_SIZE = 20
+
+class SpinupState(IntEnum):
+    # Values index MeasureFan._SPINUP_DISPATCH
+    NONE = 0
+    FIND_MAX_SET = 1
+    FIND_MAX_QUERY = 2
+    INITIAL = 3
+    WAITING_FOR_SPINUP = 4
+    STABILIZE = 5
+    TARGET = 6
+
+class RpmMeasureState:
+    """State of a MEASURE_FAN run."""
+    __slots__ = (
+        'steps', 'measure_per_step', 'step_time', 'current_step', 'current_measurement',
+        'powers', 'rpms', 'power_schedule', 'boxcar', 'step_samples', 'rpm_threshold',
+        'last_rpm', 'initial_fanstop_issued',
+    )
+
+    def __init__(self):
+        self.steps = 10
+        self.measure_per_step = 3
+        self.step_time = 3
+        self.current_step = 0
+        self.current_measurement = 0
+        self.powers = array.array('d')
+        self.rpms = array.array('d')
+        self.power_schedule = []
+        self.boxcar = False
+        self.step_samples = []
+        self.rpm_threshold = 0
+        self.last_rpm = None
+        self.initial_fanstop_issued = False
+
+class SpinupMeasureState:
+    """State of a MEASURE_FAN_SPINUP run."""
+    __slots__ = (
+        'initial_power', 'target_power', 'step_time', 'rpm_threshold', 'start_time',
+        'state', 'max_rpm', 'schedule', 'smoothing', 'ema', 'last_poll_time', 'scheduled_poll',
+    )
+
+    def __init__(self):
+        self.initial_power = 0
+        self.target_power = 0
+        self.step_time = .1
+        self.rpm_threshold = 100
+        self.start_time = None
+        self.state = SpinupState.NONE
+        self.max_rpm = 0
+        self.schedule = []
+        self.smoothing = 0.
+        self.ema = None
+        self.last_poll_time = None
+        self.scheduled_poll = False
+
+def _compute_poll_schedule(upper, polls, pdf, cdf, eps=1e-3):
+    """Place `polls` poll times in (0, upper] for an event with density `pdf`.
+
+    Poll times follow L_i = L_{i-1} + (cdf(L_{i-1}) - cdf(L_{i-2})) / pdf(L_{i-1}),
+    which minimizes the expected detection delay. The first poll time is found by
+    bisection so that the last one lands on `upper`.
+    """
+    def walk(first):
+        times = [first]
+        prev = 0.
+        while len(times) < polls and times[-1] <= upper:
+            cur = times[-1]
+            density = pdf(cur)
+            if density <= 0.:
+                times.append(math.inf)
+                break
+            times.append(cur + (cdf(cur) - cdf(prev)) / density)
+            prev = cur
+        return times
+
+    lo, hi = 0., upper
+    times = [upper]
+    for _ in range(64):
+        first = (lo + hi) / 2
+        times = walk(first)
+        if times[-1] > upper:
+            hi = first
+        elif len(times) < polls or upper - times[-1] >= eps:
+            lo = first
+        else:
+            break
+    times = [min(t, upper) for t in times[:polls]]
+    times[-1] = upper
+    return times
 
-class SpinupState(Enum):
-            NONE = -1
-            FIND_MAX_SET = 0
-            FIND_MAX_QUERY = 1
-            INITIAL = 2
-            WAITING_FOR_SPINUP = 3
-            STABILIZE = 4
-            TARGET = 5
+def _is_duration(value):
+    """Return True if `value` is a positive, finite number of seconds."""
+    return (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and math.isfinite(value) and value > 0)
 
 class MeasureFan:
     def __init__(self, config):
@@ -28,36 +121,16 @@ class MeasureFan:
         self.gcode.register_command(
             'MEASURE_FAN_SPINUP',
             self.cmd_MEASURE_FAN_SPINUP,
-            desc=self.cmd_MEASURE_FAN_help
+            desc=self.cmd_MEASURE_FAN_SPINUP_help
         )
 
         # Initialize state variables
-        self.current_gcmd = None
-        self.measure_active = False
         self.sample_timer = None
-        self.fan = None
-        self.fan_name = None
-        self.printer_ready = False
-
-        self.rpm_measure_state = {
-            'steps': 10,
-            'measure_per_step': 3,
-            'step_time': 3,
-            'current_step': 0,
-            'current_measurement': 0,
-            'data': [],
-            'initial_fanstop_issued': False
-        }
-
-        self.spinup_measure_state = {
-            'initial_power': 0,
-            'target_power': 0,
-            'step_time': .1,
-            'rpm_threshold': 100,
-            'start_time': None,
-            'state': SpinupState.NONE,
-            'max_rpm': 0,
-        }
+        self.current_gcmd = None
+        self._step_callback = None
+        self._pending_info = []
+        self._fan_cache = {}
+        self._reset_state()
 
         # Register event handler for when Klipper is ready
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
@@ -67,27 +140,33 @@ class MeasureFan:
     cmd_MEASURE_FAN_help = (
         "Run fan measurement procedure to determine minimum power required to start fan "
         "and maximum power for fan operation.\n"
-        "Usage: MEASURE_FAN [FAN=<fan_name>] [STEPS=<steps>]\n"
+        "Usage: MEASURE_FAN [FAN=<fan_name>] [STEPS=<steps>] [BOXCAR=<0|1>] [RPM_THRESHOLD=<rpm_threshold>] [VERBOSE=<0|1>]\n"
         "FAN: Name of the fan to measure. Default: fan\n"
-        "STEPS: Number of steps to run the fan through. Default: 10"
+        "STEPS: Number of steps to run the fan through. Default: 10\n"
+        "BOXCAR: Save the median of each step's MEASURE_PER_STEP + 1 readings (4 by default) instead of every reading. Default: 0\n"
+        "RPM_THRESHOLD: Move to the next step once two consecutive readings differ by less than this. Default: 0 (disabled)\n"
+        "VERBOSE: Report every fan power change and G-code command sent. Default: 0"
     )
 
     cmd_MEASURE_FAN_SPINUP_help = (
         "Run fan measurement procedure to determine the time it takes for the fan to reach a target RPM "
         "from an initial power value.\n"
-        "Usage: MEASURE_FAN_SPINUP [FAN=<fan_name>] [INITIAL_POWER=<initial_power>] [TARGET_POWER=<target_power>] [STEP_TIME=<step_time>]\n"
+        "Usage: MEASURE_FAN_SPINUP [FAN=<fan_name>] [INITIAL_POWER=<initial_power>] [TARGET_POWER=<target_power>] [STEP_TIME=<step_time>] [RPM_THRESHOLD=<rpm_threshold>] [POLLS=<polls>] [SMOOTHING=<smoothing>] [VERBOSE=<0|1>]\n"
         "FAN: Name of the fan to measure. Default: fan\n"
         "INITIAL_POWER: Initial power value to start the fan from. Default: 0\n"
         "TARGET_POWER: Target power value to reach. Default: 1\n"
         "STEP_TIME: Time in seconds to wait between setting the fan power. Default: 0.1\n"
-        "RPM_THRESHOLD: RPM difference threshold to consider the fan as stabilized. Default: 100"
+        "RPM_THRESHOLD: RPM difference threshold to consider the fan as stabilized. Default: 100\n"
+        "POLLS: Number of RPM polls placed around spin-up times previously measured with the same powers. Default: 0 (poll every STEP_TIME)\n"
+        "SMOOTHING: Weight of the previous average when smoothing RPM readings (0 to 0.99). Default: 0 (no smoothing)\n"
+        "VERBOSE: Report every fan power change and G-code command sent. Default: 0"
     )
 
     # Event Handlers
     def _handle_ready(self):
         """Register the timer for measurement steps when Klipper is ready."""
         self.printer_ready = True
-        #self.sample_timer = self.reactor.register_timer(self._next_measure_step, self.reactor.NEVER)
+        self.sample_timer = self.reactor.register_timer(self._next_measure_step, self.reactor.NEVER)
 
     def _handle_shutdown(self):
         """Reset the measure state when Klipper is shutdown."""
@@ -96,170 +175,307 @@ class MeasureFan:
     # G-code Command Handlers
     def cmd_MEASURE_FAN(self, gcmd):
         """Handle the MEASURE_FAN G-code command."""
-        if self.measure_active:
-            gcmd.respond_info("Measure already in progress")
+        if not self._start_measure(gcmd, self._next_rpm_measure_step):
             return
 
-        self._reset_state()
-        self.sample_timer = self.reactor.register_timer(self._next_rpm_measure_step, self.reactor.NEVER)
-
         # Parse G-code parameters
-        self.current_gcmd = gcmd
-        self.measure_active = True
-        self.rpm_measure_state['steps'] = int(gcmd.get('STEPS', 10))
-        self.rpm_measure_state['measure_per_step'] = int(gcmd.get('MEASURE_PER_STEP', 3))
-        self.fan_name = gcmd.get('FAN', 'fan')
-
-        # Find the fan object
-        self.fan = self._try_find_fan(self.fan_name)
-        if self.fan is None:
-            gcmd.respond_error(f"Fan {self.fan_name} not found")
-            self.measure_active = False
-            return
+        self.rpm_measure_state.steps = int(gcmd.get('STEPS', 10))
+        steps = self.rpm_measure_state.steps
+        self.rpm_measure_state.power_schedule = [i / steps for i in range(steps + 1)]
+        self.rpm_measure_state.measure_per_step = int(gcmd.get('MEASURE_PER_STEP', 3))
+        self.rpm_measure_state.boxcar = bool(int(gcmd.get('BOXCAR', 0)))
+        self.rpm_measure_state.rpm_threshold = float(gcmd.get('RPM_THRESHOLD', 0))
+        self._csv_path = self._get_filename("calibration_data", time.strftime("%Y%m%d_%H%M%S"), self.fan_name)
 
         # Start calibration
         gcmd.respond_info(f"Measuring fan {self.fan_name} ...")
-        gcmd.respond_info(f"Running fan from 0 to 100% power in {self.rpm_measure_state['steps']} steps")
+        gcmd.respond_info(f"Running fan from 0 to 100% power in {self.rpm_measure_state.steps} steps")
         self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
 
     def cmd_MEASURE_FAN_SPINUP(self, gcmd):
         """Handle the MEASURE_FAN_SPINUP G-code command."""
+        if not self._start_measure(gcmd, self._next_spinup_measure_step):
+            return
+
+        # Parse G-code parameters
+        self.spinup_measure_state.initial_power = float(gcmd.get('INITIAL_POWER', 0))
+        self.spinup_measure_state.target_power = float(gcmd.get('TARGET_POWER', 1))
+        self.spinup_measure_state.step_time = float(gcmd.get('STEP_TIME', 0.01))
+        self.spinup_measure_state.rpm_threshold = float(gcmd.get('RPM_THRESHOLD', 100))
+        self.spinup_measure_state.smoothing = min(max(float(gcmd.get('SMOOTHING', 0)), 0.), 0.99)
+        self.spinup_measure_state.schedule = self._spinup_poll_schedule(int(gcmd.get('POLLS', 0)))
+
+        self.spinup_measure_state.state = SpinupState.FIND_MAX_SET
+
+        # Start calibration
+        gcmd.respond_info(f"Measuring fan {self.fan_name} ...")
+        self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
+
+    def _start_measure(self, gcmd, step_callback):
+        """Set up a new measurement, returning False if it cannot be started."""
         if self.measure_active:
             gcmd.respond_info("Measure already in progress")
-            return
+            return False
 
         self._reset_state()
-        self.sample_timer = self.reactor.register_timer(self._next_spinup_measure_step, self.reactor.NEVER)
+        self._step_callback = step_callback
 
-        # Parse G-code parameters
         self.current_gcmd = gcmd
         self.measure_active = True
-        self.spinup_measure_state['initial_power'] = float(gcmd.get('INITIAL_POWER', 0))
-        self.spinup_measure_state['target_power'] = float(gcmd.get('TARGET_POWER', 1))
-        self.spinup_measure_state['step_time'] = float(gcmd.get('STEP_TIME', 0.01))
-        self.spinup_measure_state['rpm_threshold'] = float(gcmd.get('RPM_THRESHOLD', 100))
         self.fan_name = gcmd.get('FAN', 'fan')
+        self.verbose = bool(int(gcmd.get('VERBOSE', 0)))
 
         # Find the fan object
         self.fan = self._try_find_fan(self.fan_name)
         if self.fan is None:
             gcmd.respond_error(f"Fan {self.fan_name} not found")
             self.measure_active = False
-            return
-
-        self.spinup_measure_state['state'] = SpinupState.FIND_MAX_SET
+            return False
+        self._fan_power_cmd = self._get_fan_power_cmd(self.fan)
+        if self._fan_power_cmd is None:
+            gcmd.respond_error(f"Fan type not supported: {self.fan.__class__.__name__}")
+            self.measure_active = False
+            return False
+        return True
 
-        # Start calibration
-        gcmd.respond_info(f"Measuring fan {self.fan_name} ...")
-        self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
+    def _next_measure_step(self, eventtime):
+        """Run a step of the active measurement, then send its messages in a single response."""
+        if self._step_callback is None:
+            return self.reactor.NEVER
+        waketime = self._step_callback(eventtime)
+        self._flush_info()
+        return waketime
 
     def _try_find_fan(self, fan_name):
         """Attempt to find the fan object by name."""
+        fan = self._fan_cache.get(fan_name)
+        if fan is not None:
+            return fan
         try:
-            return self.printer.lookup_object(fan_name)
+            fan = self.printer.lookup_object(fan_name)
         except configfile.error:
             return None
+        self._fan_cache[fan_name] = fan
+        return fan
+
+    def _get_fan_power_cmd(self, fan):
+        """Return a function building the G-code command that sets the fan power."""
+        fan_type = fan.__class__.__name__
+        if fan_type == 'PrinterFan':
+            return lambda power: f"M106 S{int(power * 255)}"
+        elif fan_type == 'PrinterFanGeneric':
+            fan_name = self.fan_name
+            return lambda power: f"SET_FAN_SPEED FAN={fan_name} SPEED={power}"
+        return None
 
     # Measure Logic
     def _next_rpm_measure_step(self, eventtime):
         """Perform the next step in the measure process."""
         state = self.rpm_measure_state
 
-        if state['current_step'] == 0:
+        if state.current_step == 0:
             fan_rpm = self._measure_fan_speed(eventtime)
             if fan_rpm is not None and fan_rpm > 0:
-                self.current_gcmd.respond_info(f"Fan is already spinning at {fan_rpm}, waiting for it to stop")
-                if not state['initial_fanstop_issued']:
+                if self.verbose:
+                    self._respond_info(f"Fan is already spinning at {fan_rpm}, waiting for it to stop")
+                if not state.initial_fanstop_issued:
                     self._set_fan_power(0)
-                    state['initial_fanstop_issued'] = True
-                return self.reactor.monotonic() + 1
+                    state.initial_fanstop_issued = True
+                return eventtime + 1
 
         fan_rpm = self._measure_fan_speed(eventtime)
 
         if fan_rpm is not None:
-            state['data'].append({
-                'power': (100 / state['steps']) * state['current_step'],
-                'rpm': fan_rpm
-            })
+            state.step_samples.append(fan_rpm)
+            if not state.boxcar:
+                self._store_step_samples(state)
+            # Skip the remaining samples of this step once consecutive readings agree
+            if (state.current_measurement >= 2 and state.last_rpm is not None
+                    and abs(fan_rpm - state.last_rpm) < state.rpm_threshold):
+                state.current_measurement = state.measure_per_step
+            state.last_rpm = fan_rpm
 
         # Measure fan speed multiple times per step
-        if state['current_measurement'] < state['measure_per_step']:
-            state['current_measurement'] += 1
-            return self.reactor.monotonic() + 0.5
+        if state.current_measurement < state.measure_per_step:
+            state.current_measurement += 1
+            return eventtime + 0.5
 
         # Move to the next step
-        state['current_measurement'] = 0
-        state['current_step'] += 1
+        self._store_step_samples(state)
+        state.current_measurement = 0
+        state.last_rpm = None
+        state.current_step += 1
 
-        if state['current_step'] > state['steps']:
+        if state.current_step > state.steps:
             self._rpm_measure_complete()
             return self.reactor.NEVER
 
         # Set fan power for the current step
-        current_power = (100 / state['steps']) * state['current_step']
-        power_scaled = current_power / 100
-        self.current_gcmd.respond_info(f"Setting fan power to {current_power:.2f}%")
-        self._set_fan_power(power_scaled)
+        power = state.power_schedule[state.current_step]
+        if self.verbose:
+            self._respond_info(f"Setting fan power to {power * 100:.2f}%")
+        self._set_fan_power(power)
+
+        return eventtime + state.step_time
 
-        return self.reactor.monotonic() + state['step_time']
+    def _store_step_samples(self, state):
+        """Store the median of the buffered samples for the current step."""
+        samples = state.step_samples
+        if samples:
+            state.powers.append(state.power_schedule[state.current_step])
+            state.rpms.append(statistics.median(samples))
+            samples.clear()
 
     # Spinup Measure Logic
     # This is a separate measure process that only measures the fan from a given initial power value (giving it the step_time to spin up)
     # then sets the fan_power to a given target power value and measures the RPM in shit time periods waiting the RPM to stabilize then prints out the time it took the fan to reach that RPM
     def _next_spinup_measure_step(self, eventtime):
         state = self.spinup_measure_state
+        return self._SPINUP_DISPATCH[state.state](self, state, eventtime)
+
+    def _spinup_find_max_set(self, state, eventtime):
+        if self.verbose:
+            self._respond_info("Setting fan to target power to find target RPM")
+        self._set_fan_power(state.target_power)
+        state.state = SpinupState.FIND_MAX_QUERY
+        return eventtime + 5
+
+    def _spinup_find_max_query(self, state, eventtime):
+        rpm = self._measure_fan_speed(eventtime)
+        state.max_rpm = rpm
+        self._respond_info(f"Target RPM is {rpm}")
+        state.state = SpinupState.INITIAL
+        return self.reactor.NOW
+
+    def _spinup_initial(self, state, eventtime):
+        if self.verbose:
+            self._respond_info("Setting fan to initial power")
+        self._set_fan_power(state.initial_power)
+        state.state = SpinupState.WAITING_FOR_SPINUP
+
+        #Give the fan enough time to reach the target RPM
+        return eventtime + 3
+
+    def _spinup_waiting_for_spinup(self, state, eventtime):
+        self._set_fan_power(state.target_power)
+        state.state = SpinupState.STABILIZE
+        state.start_time = eventtime
+        state.last_poll_time = eventtime
+        return self._next_spinup_poll(state, eventtime)
+
+    def _spinup_stabilize(self, state, eventtime):
+        fan_rpm = self._measure_fan_speed(eventtime)
+        if fan_rpm is None:
+            self._respond_info("Fan RPM is not readable, aborting measurement")
+            self._reset_state()
+            self.measure_active = False
+            return self.reactor.NEVER
 
-
-        if state['state'] == SpinupState.FIND_MAX_SET:
-            self.current_gcmd.respond_info("Setting fan to target power to find target RPM")
-            self._set_fan_power(state['target_power'])
-            state['state'] = SpinupState.FIND_MAX_QUERY
-            return self.reactor.monotonic() + 5
-        elif state['state'] == SpinupState.FIND_MAX_QUERY:
-            rpm = self._measure_fan_speed(eventtime)
-            state['max_rpm'] = rpm
-            self.current_gcmd.respond_info(f"Target RPM is {rpm}")
-            state['state'] = SpinupState.INITIAL
-            return self.reactor.NOW
-        elif state['state'] == SpinupState.INITIAL:
-            self.current_gcmd.respond_info("Setting fan to initial power")
-            self._set_fan_power(state['initial_power'])
-            state['state'] = SpinupState.WAITING_FOR_SPINUP
-
-            #Give the fan enough time to reach the target RPM
-            return self.reactor.monotonic() + 3
-        elif state['state'] == SpinupState.WAITING_FOR_SPINUP:
-            self._set_fan_power(state['target_power'])
-            state['state'] = SpinupState.STABILIZE
-            state['start_time'] = self.reactor.monotonic()
-            return self.reactor.monotonic() + state['step_time']
-        elif state['state'] == SpinupState.STABILIZE:
-            fan_rpm = self._measure_fan_speed(eventtime)
-            if fan_rpm is None:
-                self.current_gcmd.respond_info("Fan RPM is not readable, aborting measurement")
-                self._reset_state()
-                self.measure_active = False
-                return self.reactor.NEVER
-            elif abs(state['max_rpm'] - fan_rpm ) > state['rpm_threshold']:
-                return self.reactor.monotonic() + state['step_time']
-            elif abs(state['max_rpm'] - fan_rpm ) < state['rpm_threshold']:
-                state['state'] = SpinupState.TARGET
-                duration = self.reactor.monotonic() - state['start_time']
-                self.current_gcmd.respond_info(f"Fan reached target RPM in {duration:.2f} seconds")
-                self._spinup_measure_complete()
-                return self.reactor.NEVER
-            else:
-                self.current_gcmd.respond_info("Unknown error, aborting measurement")
-                self._reset_state()
-                self.measure_active = False
-                return self.reactor.NEVER
-            
-            
+        # Exponential moving average of the readings, the raw reading when SMOOTHING is 0
+        if state.ema is None:
+            state.ema = fan_rpm
         else:
+            state.ema = state.smoothing * state.ema + (1. - state.smoothing) * fan_rpm
+
+        if abs(state.max_rpm - state.ema) > state.rpm_threshold:
+            state.last_poll_time = eventtime
+            return self._next_spinup_poll(state, eventtime)
+        elif abs(state.max_rpm - state.ema) < state.rpm_threshold:
+            state.state = SpinupState.TARGET
+            # The fan got there some time between the previous poll and this one
+            lower = state.last_poll_time - state.start_time
+            upper = eventtime - state.start_time
+            if not state.scheduled_poll:
+                # Scheduled polls are too far apart to time the spin-up, only
+                # record durations bracketed by regular STEP_TIME polls
+                self._record_spinup_duration((lower + upper) / 2)
+            self._respond_info(f"Fan reached target RPM in {lower:.2f} to {upper:.2f} seconds")
+            self._spinup_measure_complete()
+            return self.reactor.NEVER
+        else:
+            self._respond_info("Unknown error, aborting measurement")
             self._reset_state()
             self.measure_active = False
             return self.reactor.NEVER
-    
+
+    def _spinup_abort(self, state, eventtime):
+        self._reset_state()
+        self.measure_active = False
+        return self.reactor.NEVER
+
+    # Handlers indexed by SpinupState
+    _SPINUP_DISPATCH = (
+        _spinup_abort,               # NONE
+        _spinup_find_max_set,        # FIND_MAX_SET
+        _spinup_find_max_query,      # FIND_MAX_QUERY
+        _spinup_initial,             # INITIAL
+        _spinup_waiting_for_spinup,  # WAITING_FOR_SPINUP
+        _spinup_stabilize,           # STABILIZE
+        _spinup_abort,               # TARGET
+    )
+
+    def _next_spinup_poll(self, state, eventtime):
+        """Return the wake-up time of the next RPM poll while the fan spins up."""
+        schedule = state.schedule
+        while schedule:
+            waketime = state.start_time + schedule.pop(0)
+            if waketime > eventtime:
+                state.scheduled_poll = True
+                return waketime
+        state.scheduled_poll = False
+        return eventtime + state.step_time
+
+    def _spinup_poll_schedule(self, polls):
+        """Build a poll schedule from the spin-up durations recorded for this fan."""
+        durations = self._load_spinup_history().get(self._spinup_history_key())
+        if polls <= 0 or not durations:
+            return []
+
+        # Truncated Gaussian around the median observed spin-up duration
+        mu = statistics.median(durations)
+        sigma = statistics.stdev(durations) if len(durations) > 1 else 0.
+        sigma = max(sigma, 0.25 * mu, 0.01)
+        upper = mu + 3 * sigma
+        scale = sigma * math.sqrt(2 * math.pi)
+        pdf = lambda t: math.exp(-0.5 * ((t - mu) / sigma) ** 2)
+        cdf = lambda t: 0.5 * scale * (1 + math.erf((t - mu) / (sigma * math.sqrt(2))))
+        return _compute_poll_schedule(upper, polls, pdf, cdf)
+
+    def _spinup_history_key(self):
+        """Return the history key of the current fan, power range and smoothing."""
+        state = self.spinup_measure_state
+        key = f"{self.fan_name}:{state.initial_power:.2f}:{state.target_power:.2f}"
+        if state.smoothing:
+            # Smoothed durations include the EMA lag, keep them apart
+            key += f":{state.smoothing:.2f}"
+        return key
+
+    def _load_spinup_history(self):
+        """Load the recorded spin-up durations, keyed by fan and power range."""
+        try:
+            with open(SPINUP_HISTORY_FILE, 'r') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(history, dict):
+            return {}
+        # Drop entries that are not lists of positive durations, e.g. from a hand-edited file
+        return {key: durations for key, durations in history.items()
+                if isinstance(durations, list) and durations and all(map(_is_duration, durations))}
+
+    def _record_spinup_duration(self, duration):
+        """Append a measured spin-up duration to the history of this fan and power range."""
+        key = self._spinup_history_key()
+        history = self._load_spinup_history()
+        durations = history.get(key, [])[-(SPINUP_HISTORY_SIZE - 1):]
+        durations.append(duration)
+        history[key] = durations
+        try:
+            with open(SPINUP_HISTORY_FILE, 'w') as f:
+                json.dump(history, f)
+        except OSError:
+            pass
+
     def _measure_fan_speed(self, eventtime):
         """Measure the fan speed and store the result."""
         if not self.measure_active:
@@ -270,81 +486,70 @@ class MeasureFan:
 
     def _rpm_measure_complete(self):
         """Complete the measure process."""
-        self.current_gcmd.respond_info("Setting fan power to 0%")
+        if self.verbose:
+            self._respond_info("Setting fan power to 0%")
         self._set_fan_power(0)
-        self.current_gcmd.respond_info("Saving calibration data...")
-        self._save_measure_data(self.rpm_measure_state['data'])
+        if self.verbose:
+            self._respond_info("Saving calibration data...")
+        self._save_measure_data(self._csv_path, self.rpm_measure_state.powers, self.rpm_measure_state.rpms)
         self.measure_active = False
         self._reset_state()
 
     def _spinup_measure_complete(self):
         """Complete the measure process."""
         self._set_fan_power(0)
-        self.current_gcmd.respond_info("Measurement complete")
+        self._respond_info("Measurement complete")
         self.measure_active = False
         self._reset_state()
 
     # Utility Methods
-    def _save_measure_data(self, data, name="calibration_data",):
+    def _save_measure_data(self, filename, powers, rpms):
         """Save the calibration data to a CSV file."""
-        filename = self._get_filename(name, time.strftime("%Y%m%d_%H%M%S"), self.fan_name)
-        with open(filename, 'w') as f:
-            f.write("Power, RPM\n")
-            for d in data:
-                f.write(f"{d['power'] / 100:.2f}, {d['rpm']:.2f}\n")
-        self.current_gcmd.respond_info(f"Calibration data saved to {filename}")
+        # Build the whole file in memory and hand it to a large buffered writer
+        # so the data lands on disk in a single write instead of one per row
+        body = "Power, RPM\n" + "".join(CSV_ROW_FORMAT % row for row in zip(powers, rpms))
+        with open(filename, 'w', buffering=65536) as f:
+            f.write(body)
+        self._respond_info(f"Calibration data saved to {filename}")
 
     def _set_fan_power(self, power):
         """Set the fan power using the appropriate G-code command."""
-        if self.fan.__class__.__name__ == 'PrinterFan':
-            power_scaled = int(power * 255)
-            cmd_str = f"M106 S{power_scaled}"
-        elif self.fan.__class__.__name__ == 'PrinterFanGeneric':
-            cmd_str = f"SET_FAN_SPEED FAN={self.fan_name} SPEED={power}"
-        else:
-            self.current_gcmd.respond_info(f"Fan type not supported: {self.fan.__class__.__name__}")
-            return
-
-        self.current_gcmd.respond_info(f"Sending command: {cmd_str}")
+        cmd_str = self._fan_power_cmd(power)
+        if self.verbose:
+            self._respond_info(f"Sending command: {cmd_str}")
         self.gcode.run_script(cmd_str)
 
+    def _respond_info(self, msg):
+        """Queue a message to be sent once the current step is done."""
+        self._pending_info.append(msg)
+
+    def _flush_info(self):
+        """Send all queued messages as a single G-code response."""
+        if self._pending_info and self.current_gcmd is not None:
+            self.current_gcmd.respond_info("\n".join(self._pending_info))
+        self._pending_info = []
+
     def _reset_state(self):
         """Reset the measure state."""
-        self.rpm_measure_state = {
-            'current_step': 0,
-            'current_measurement': 0,
-            'data': [],
-            'steps': 10,
-            'measure_per_step': 3,
-            'step_time': 3,
-            'initial_fanstop_issued': False
-        }
-        self.spinup_measure_state = {
-            'initial_power': 0,
-            'target_power': 0,
-            'step_time': .1,
-            'start_time': None,
-            'state': SpinupState.NONE,
-            'data': [],
-            'max_rpm': 0,
-        }
+        self._flush_info()
+        self.rpm_measure_state = RpmMeasureState()
+        self.spinup_measure_state = SpinupMeasureState()
         self.current_gcmd = None
         self.measure_active = False
         self.fan = None
         self.fan_name = None
+        self._fan_power_cmd = None
+        self._csv_path = None
+        self.verbose = False
         self.printer_ready = False
+        self._step_callback = None
         if self.sample_timer is not None:
             self.reactor.update_timer(self.sample_timer, self.reactor.NEVER)
-            self.reactor.unregister_timer(self.sample_timer)
-        self.sample_timer = None
 
     def _get_filename(self, base, name_suffix, fan_name=None):
         """Generate a filename for saving calibration data."""
-        name = base
-        if fan_name:
-            name += f"_{fan_name}"
-        name += f"_{name_suffix}"
-        return os.path.join("/tmp", f"{name}.csv")
+        parts = (base, fan_name, name_suffix) if fan_name else (base, name_suffix)
+        return os.path.join("/tmp", "_".join(parts) + ".csv")
 
 
 def load_config(config):
@@ -1,88 +1,102 @@
 #!/usr/bin/env python3
 
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-import csv
-from typing import Dict, List
+from typing import Dict, List, Optional
+import argparse
 import os
 import sys
+import warnings
 import numpy as np
-from statistics import mean, stdev
-
-def load_data(file_path: str) -> Dict[float, List[float]]:
-    """Load CSV data from a file."""
-    data = {}
-    with open(file_path, "r") as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip header row
-        for row in reader:
-            # Skip rows that do not have at least 2 columns
-            if len(row) < 2:
-                continue
-            try:
-                power, rpm = float(row[0]), float(row[1])
-                if power not in data:
-                    data[power] = []
-                data[power].append(rpm)
-            except ValueError:
-                # Skip rows with invalid data
-                continue
-    return data
-
-def prepare_plot_data(file_path: str) -> Dict[str, List[float]]:
+
+# A single figure is reused for every plot so the backend is only set up once
+_FIG, _AX = plt.subplots(figsize=(20, 10))
+
+def load_data(file_path: str) -> Dict[float, np.ndarray]:
+    """Load CSV data from a file, grouping the RPM values by power."""
+    with warnings.catch_warnings():
+        # Rows that do not have at least 2 columns are skipped with a warning
+        warnings.simplefilter("ignore")
+        arr = np.genfromtxt(file_path, delimiter=",", skip_header=1, usecols=(0, 1),
+                            invalid_raise=False, ndmin=2)
+    if arr.size == 0:
+        return {}
+
+    # Skip rows with invalid data
+    arr = arr[~np.isnan(arr).any(axis=1)]
+
+    # Sort by power and split the RPM values at each new power setting
+    order = np.argsort(arr[:, 0], kind="stable")
+    power, rpm = arr[order, 0], arr[order, 1]
+    keys, starts = np.unique(power, return_index=True)
+    return dict(zip(keys.tolist(), np.split(rpm, starts[1:])))
+
+def prepare_plot_data(file_path: str) -> Dict[str, list]:
     """Prepare x and y values for plotting from a single dataset."""
     data = load_data(file_path)
     all_x_values = sorted(data.keys())
     y_values = [data[x] for x in all_x_values]
     return {"x_values": all_x_values, "y_values": y_values}
 
-def plot_data(x_values: List[float], y_values: List[List[float]], label: str, output_file: str, color: str = "blue"):
+def plot_data(x_values: List[float], y_values: List[np.ndarray], label: str, output_file: str, color: str = "blue",
+              dpi: int = 150):
     """Plot the data and save it to a file."""
-    plt.figure(figsize=(20, 10))
+    _AX.clear()
+
+    # Pad the RPM values into a 2D array with one row per power setting
+    counts = np.array([len(rpms) for rpms in y_values])
+    rpm_grid = np.full((len(y_values), counts.max()), np.nan)
+    rpm_grid[np.arange(counts.max()) < counts[:, None]] = np.concatenate(y_values)
 
     # Calculate mean and standard deviation for each power setting
-    means = [mean(rpms) for rpms in y_values]
-    stdevs = [stdev(rpms) if len(rpms) > 1 else 0 for rpms in y_values]
+    means = np.nanmean(rpm_grid, axis=1)
+    # Sample stdev, left at 0 for power settings with a single sample
+    sq_dev = np.nansum((rpm_grid - means[:, None]) ** 2, axis=1)
+    stdevs = np.sqrt(np.divide(sq_dev, counts - 1, out=np.zeros_like(sq_dev), where=counts > 1))
 
     # Plot the mean line
-    plt.plot(x_values, means, label=label, color=color)
+    _AX.plot(x_values, means, label=label, color=color)
 
     # Plot all individual RPM values as scatter points
-    for x, rpms in zip(x_values, y_values):
-        plt.scatter([x] * len(rpms), rpms, color=color, alpha=0.5, edgecolor="black", zorder=5, s=3)
+    _AX.scatter(np.repeat(x_values, counts), np.concatenate(y_values),
+                color=color, alpha=0.5, edgecolor="black", zorder=5, s=3)
 
     # Add a shaded region for the standard deviation
-    lower_bound = [m - s for m, s in zip(means, stdevs)]
-    upper_bound = [m + s for m, s in zip(means, stdevs)]
-    plt.fill_between(x_values, lower_bound, upper_bound, color=color, alpha=0.9, label="±1 stdev")
+    lower_bound = means - stdevs
+    upper_bound = means + stdevs
+    _AX.fill_between(x_values, lower_bound, upper_bound, color=color, alpha=0.9, label="±1 stdev")
 
     # Filter out 0 values and those with outstandingly large ranges for min_rpm calculation
-    ranges = [u - l for u, l in zip(upper_bound, lower_bound)]
-    threshold = np.mean(ranges) + 2 * np.std(ranges)  # Define an outlier threshold
-    filtered_means = [
-        rpm for rpm, r in zip(means, ranges) if rpm > 0 and r <= threshold
-    ]
-    min_rpm = min(filtered_means)
-    min_power = x_values[means.index(min_rpm)]
+    ranges = upper_bound - lower_bound
+    threshold = ranges.mean() + 2 * ranges.std()  # Define an outlier threshold
+    candidates = np.flatnonzero((means > 0) & (ranges <= threshold))
+    min_index = candidates[np.argmin(means[candidates])]
+    min_rpm = means[min_index]
+    min_power = x_values[min_index]
 
     # Find max_power based on the derivative of the means line, ignoring zero values
-    non_zero_means = [m for m in means if m > 0]
-    non_zero_x_values = [x for x, m in zip(x_values, means) if m > 0]
+    non_zero = means > 0
+    non_zero_means = means[non_zero]
+    non_zero_x_values = np.asarray(x_values)[non_zero]
     derivatives = np.gradient(non_zero_means, non_zero_x_values)  # Calculate the numerical derivative
     derivative_threshold = 10  # Define a threshold for a nearly horizontal line
-    max_power_index = next(
-        (i for i, d in enumerate(derivatives) if abs(d) < derivative_threshold),
-        len(non_zero_x_values) - 1,  # Default to the last index if no threshold is met
-    )
-    max_power = non_zero_x_values[max_power_index-1]
-    max_rpm = non_zero_means[max_power_index-1]
+    flat = np.flatnonzero(np.abs(derivatives) < derivative_threshold)
+    # Default to the last index if no threshold is met
+    max_power_index = flat[0] if flat.size else len(non_zero_x_values) - 1
+    # Take the point before it, clamped so a fan that is flat from the start
+    # does not wrap around to the end of the array
+    max_power_index = max(max_power_index - 1, 0)
+    max_power = non_zero_x_values[max_power_index]
+    max_rpm = non_zero_means[max_power_index]
 
     # Add horizontal lines for min and max RPM values
-    plt.axhline(y=min_rpm, color="green", linestyle="--", label=f"Min RPM: {min_rpm}")
-    plt.axhline(y=max_rpm, color="red", linestyle="--", label=f"Max RPM: {max_rpm}")
+    _AX.axhline(y=min_rpm, color="green", linestyle="--", label=f"Min RPM: {min_rpm}")
+    _AX.axhline(y=max_rpm, color="red", linestyle="--", label=f"Max RPM: {max_rpm}")
 
     # Add vertical lines at min_power and max_power
-    plt.axvline(x=min_power, color="green", linestyle="--", label=f"Min Power: {min_power}")
-    plt.axvline(x=max_power, color="red", linestyle="--", label=f"Max Power: {max_power}")
+    _AX.axvline(x=min_power, color="green", linestyle="--", label=f"Min Power: {min_power}")
+    _AX.axvline(x=max_power, color="red", linestyle="--", label=f"Max Power: {max_power}")
 
     # Add a textbox with recommended settings
     text = (
@@ -90,25 +104,26 @@ def plot_data(x_values: List[float], y_values: List[List[float]], label: str, ou
         f"min_power: {min_power:.2f}\n"
         f"max_power: {max_power:.2f}"
     )
-    plt.text(
-        0.05, 0.95, text, transform=plt.gca().transAxes, fontsize=10,
+    _AX.text(
+        0.05, 0.95, text, transform=_AX.transAxes, fontsize=10,
         verticalalignment="top", bbox=dict(boxstyle="round", facecolor="white", alpha=0.5)
     )
 
     # Determine the first non-zero power value
-    first_non_zero_index = next((i for i, rpms in enumerate(y_values) if any(rpm > 0 for rpm in rpms)), 0)
+    spinning = np.flatnonzero(np.nanmax(rpm_grid, axis=1) > 0)
+    first_non_zero_index = spinning[0] if spinning.size else 0
     first_non_zero_power = x_values[first_non_zero_index]
 
     # Set the x-axis limits to start from the first non-zero power value
-    plt.xlim(left=first_non_zero_power)
+    _AX.set_xlim(left=first_non_zero_power)
 
 
     # Labels and title
-    plt.xlabel("Power")
-    plt.ylabel("RPM")
-    plt.title("Power vs RPM")
-    plt.legend()
-    plt.grid(True)
+    _AX.set_xlabel("Power")
+    _AX.set_ylabel("RPM")
+    _AX.set_title("Power vs RPM")
+    _AX.legend()
+    _AX.grid(True)
 
     # Customize x-axis labels to show 10 evenly spaced values from the range of x_values
     num_ticks = 20
@@ -128,39 +143,52 @@ def plot_data(x_values: List[float], y_values: List[List[float]], label: str, ou
     for i in range(len(tick_positions)-1):
         if abs(max_power - tick_positions[i]) < 0.025 and tick_positions[i] != max_power:
             tick_positions = np.delete(tick_positions, i)
-    plt.xticks(ticks=tick_positions, labels=[f"{tick:.2f}" for tick in tick_positions])
+    _AX.set_xticks(tick_positions)
+    _AX.set_xticklabels([f"{tick:.2f}" for tick in tick_positions])
 
     # Save the plot to a file
-    plt.savefig(output_file, format="png", dpi=300)
+    _FIG.savefig(output_file, format="png", dpi=dpi)
     print(f"Plot saved to {output_file}")
 
     # Show the plot
     # plt.show()
 
+def get_output_file(input_file: str, output_arg: Optional[str]) -> str:
+    """Determine the output file path for an input CSV file."""
+    # Default output file name: input filename without path, with .png extension
+    name = os.path.splitext(os.path.basename(input_file))[0] + ".png"
+    if output_arg is None:
+        return name
+    if os.path.isdir(output_arg):
+        # If the output argument is a directory, save the plot in it
+        return os.path.join(output_arg, name)
+    # If the output argument is a file path, use it as is
+    return output_arg
+
 # Main execution
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python calibrate_fan.py <input_csv_file> [output_file_or_directory]")
-        sys.exit(1)
-
-    input_file = sys.argv[1]
-    if not os.path.isfile(input_file):
-        print(f"Error: File '{input_file}' not found.")
+    parser = argparse.ArgumentParser(
+        usage="python calibrate_fan.py [--dpi DPI] <input_csv_file>... [output_file_or_directory]",
+        description="Plot fan calibration data.")
+    parser.add_argument("paths", nargs="+", help="input CSV files, optionally followed by an output file or directory")
+    parser.add_argument("--dpi", type=int, default=150, help="resolution of the saved plot (default: 150, use 300 for final output)")
+    args = parser.parse_args()
+
+    # A trailing argument that is not a CSV file is the output file or directory
+    input_files, output_arg = args.paths, None
+    if len(input_files) > 1 and not input_files[-1].lower().endswith(".csv"):
+        input_files, output_arg = input_files[:-1], input_files[-1]
+    if len(input_files) > 1 and output_arg is not None and not os.path.isdir(output_arg):
+        print(f"Error: '{output_arg}' must be a directory when plotting multiple files.")
         sys.exit(1)
 
-    # Determine output file path
-    if len(sys.argv) > 2:
-        output_arg = sys.argv[2]
-        if os.path.isdir(output_arg):
-            # If the second argument is a directory, use it to construct the output file path
-            output_file = os.path.join(output_arg, os.path.splitext(os.path.basename(input_file))[0] + ".png")
-        else:
-            # If the second argument is a file path, use it as is
-            output_file = output_arg
-    else:
-        # Default output file path: use input filename without path, with .png extension
-        output_file = os.path.splitext(os.path.basename(input_file))[0] + ".png"
+    for input_file in input_files:
+        if not os.path.isfile(input_file):
+            print(f"Error: File '{input_file}' not found.")
+            sys.exit(1)
 
     # Prepare data and plot
-    plot_data_dict = prepare_plot_data(input_file)
-    plot_data(plot_data_dict["x_values"], plot_data_dict["y_values"], label=os.path.basename(input_file), output_file=output_file)
\ No newline at end of file
+    for input_file in input_files:
+        plot_data_dict = prepare_plot_data(input_file)
+        plot_data(plot_data_dict["x_values"], plot_data_dict["y_values"], label=os.path.basename(input_file),
+                  output_file=get_output_file(input_file, output_arg), dpi=args.dpi)